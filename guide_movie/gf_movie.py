@@ -9,23 +9,35 @@ Edited 2018/09/18 by Joey Chatelain -- print Request number rather than tracking
 Edited 2018/10/09 by Joey Chatelain -- accomodate older guide frames (from May 2018)
 Edited 2019/05/10 by Joey Chatelain -- eliminate projection warning, add progress bar.
 Edited 2019/08/14 by Joey Chatelain -- Add postage stamp option
+
+Per-pixel image math should stay vectorized: use whole-array (ideally in-place) numpy operations
+such as apply_scale, never np.apply_along_axis, np.vectorize or Python loops over pixels.
 """
 
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
-from matplotlib.animation import FuncAnimation
+from matplotlib.animation import FFMpegWriter
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.wcs._wcs import InvalidTransformError
 from astropy.visualization import ZScaleInterval
+from PIL import Image
 from datetime import datetime
 import os
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
 import warnings
 
+# extensions that may hold the science image, in order of preference (falls back to the primary HDU)
+SCI_EXTENSIONS = ('SCI', 'COMPRESSED_IMAGE')
+# DATE-OBS formats, only needed where fromisoformat is too strict (python < 3.11)
+DATE_FORMAT_US = '%Y-%m-%dT%H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# characters in object names that are not safe to put in a filename
+FILENAME_SAFE = str.maketrans({' ': '_', '/': '_', ':': '_'})
+
 
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', time_in=None):
     """
@@ -42,7 +54,7 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
     """
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
+    bar = (fill * filled_length).ljust(length, '-')
     if time_in is not None:
         now = datetime.now()
         delta_t = now-time_in
@@ -63,117 +75,234 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, tr=False, center=False, progress=False):
+def apply_scale(data, offset, scale):
+    """
+    Rescales an image in place as (data - offset) / scale without allocating temporaries.
+    <data> = float32 image array (modified in place)
+    <offset> = value subtracted from every pixel (e.g. median sky)
+    <scale> = value every pixel is then divided by (e.g. std)
+    output = data
+    """
+    np.subtract(data, offset, out=data, dtype=np.float32)
+    np.multiply(data, 1.0 / scale, out=data, dtype=np.float32)
+    return data
+
+
+def zscale_limits(data, nsamples=1000):
+    """
+    Finds zscale display limits from a strided sample of the image rather than scanning every pixel.
+    <data> = image array
+    <nsamples> = [optional] approximate number of pixels to sample, matching ZScaleInterval's own sample size [default = 1000]
+    output = (vmin, vmax)
+    """
+    sample = data.ravel()[::max(1, data.size // nsamples)]
+    return ZScaleInterval().get_limits(sample)
+
+
+def bin_frame(data, header, binning):
+    """
+    Block-averages an image by an integer factor and rescales its wcs to match.
+    <data> = 2D image array
+    <header> = header of image
+    <binning> = integer binning factor
+    output = (binned data, binned header copy)
+    """
+    ny = data.shape[0] // binning
+    nx = data.shape[1] // binning
+    data = data[:ny*binning, :nx*binning].reshape(ny, binning, nx, binning).mean(axis=(1, 3), dtype=np.float32)
+    header = header.copy()
+    for key in ('CRPIX1', 'CRPIX2'):
+        if key in header:
+            header[key] = (header[key] - 0.5) / binning + 0.5
+    for key in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'CDELT1', 'CDELT2', 'PIXSCALE'):
+        if key in header:
+            header[key] = header[key] * binning
+    return data, header
+
+
+def get_sci_hdu(hdul):
+    """
+    Picks the HDU holding the science image out of an open fits file.
+    <hdul> = HDUList of open .fits or .fits.fz frame
+    output = science HDU (data is only read from disk when accessed)
+    """
+    for name in SCI_EXTENSIONS:
+        if name in hdul:
+            return hdul[name]
+    return hdul[0]
+
+
+def crop_frame(data, header, crop):
+    """
+    Trims the same number of pixels from opposite edges of an image and shifts its wcs to match.
+    <data> = 2D image array
+    <header> = header of image
+    <crop> = (rows, columns) to remove from each edge
+    output = (cropped data, shifted header copy)
+    """
+    y_frac, x_frac = crop
+    data = data[y_frac:data.shape[0]-y_frac, x_frac:data.shape[1]-x_frac]
+    header = header.copy()
+    if 'CRPIX1' in header:
+        header['CRPIX1'] = header['CRPIX1'] - x_frac
+    if 'CRPIX2' in header:
+        header['CRPIX2'] = header['CRPIX2'] - y_frac
+    return data, header
+
+
+def read_frame(fits_file, binning=1, crop=None):
+    """
+    Reads the science image and header from a single frame.
+    <fits_file> = path of .fits or .fits.fz frame
+    <binning> = [optional] integer factor to block-average the image by [default = 1 (no binning)]
+    <crop> = [optional] (rows, columns) to trim from each edge before binning [default = None (no crop)]
+    output = (data, header) with data as float32
+    """
+    with fits.open(fits_file, ignore_missing_end=True) as hdul:
+        hdu = get_sci_hdu(hdul)
+        data = hdu.data.astype(np.float32, copy=False)
+        header = hdu.header
+    if crop:
+        data, header = crop_frame(data, header, crop)
+    if binning > 1:
+        data, header = bin_frame(data, header, binning)
+    return data, header
+
+
+def load_frames(fits_files, max_size=None, center=False):
+    """
+    Reads and decompresses every frame once, up front, spread across a thread pool.
+    <fits_files> = list of .fits frame paths
+    <max_size> = [optional] frames larger than this many pixels on a side are binned down to ~900 pixels,
+                 roughly the resolution of the saved gif [default = None (never bin)]
+    <center> = [optional] bool to keep only the central snapshot of each frame [default = False]
+    output = (cube, headers) where cube is an (N, H, W) float32 array and headers the matching list of headers
     """
-    takes in list of .fits guide frames and turns them into a moving gif.
+    data, header = read_frame(fits_files[0])
+    # all frames share a shape, so the center crop is found once from the first frame
+    crop = None
+    if center:
+        crop = (int(data.shape[0]/2.5), int(data.shape[1]/2.5))
+        data, header = crop_frame(data, header, crop)
+    binning = 1
+    if max_size and max(data.shape) > max_size:
+        binning = max(data.shape) // 900
+        data, header = bin_frame(data, header, binning)
+    cube = np.empty((len(fits_files),) + data.shape, dtype=np.float32)
+    headers = [None] * len(fits_files)
+    cube[0] = data
+    headers[0] = header
+    # decompression releases the GIL, so threads overlap I/O and decoding
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+        futures = {ex.submit(read_frame, fits_file, binning, crop): i for i, fits_file in enumerate(fits_files[1:], 1)}
+        for future in as_completed(futures):
+            i = futures[future]
+            data, header = future.result()
+            if data.shape != cube.shape[1:]:
+                raise ValueError('{} has shape {}, expected {} like the first frame'.format(fits_files[i], data.shape, cube.shape[1:]))
+            cube[i], headers[i] = data, header
+    return cube, headers
+
+
+def write_fast_gif(cube, durations, savefile):
+    """
+    Writes frames straight to a grayscale gif, without matplotlib, using one z-scale for the whole movie.
+    <cube> = (N, H, W) float32 array of frames (rescaled in place)
+    <durations> = list of display times for each frame in ms
+    <savefile> = path of output gif
+    """
+    vmin, vmax = zscale_limits(cube)  # the cube is contiguous, so this strides across every frame without a copy
+    # a flat or saturated cube has vmax == vmin; keep the scale finite
+    scale = max(vmax - vmin, 1e-6) / 255.
+    gif_frames = []
+    for data in cube:
+        apply_scale(data, vmin, scale)
+        np.clip(data, 0, 255, out=data)
+        # 8 bit grayscale maps directly onto the gif palette, so no color quantization is needed
+        # flip so row 0 is at the bottom, matching origin='lower' in the annotated movie
+        gif_frames.append(Image.fromarray(np.flipud(data).astype(np.uint8)))
+    gif_frames[0].save(savefile, save_all=True, append_images=gif_frames[1:], duration=durations, loop=0, optimize=True)
+
+
+def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, tr=False, center=False, progress=False, fmt='gif', fast=False):
+    """
+    takes in list of .fits guide frames and turns them into a moving gif (or mp4).
     <frames> = list of .fits frame paths
     <title> = [optional] string containing gif title, set to empty string or False for no title
     <sort> = [optional] bool to sort frames by title (Which usually corresponds to date)
     <fr> = frame rate for output gif in ms/frame [default = 100 ms/frame or 10fps]
     <init_fr> = frame rate for first 5 frames in ms/frame [default = 1000 ms/frame or 1fps]
-    output = savefile (path of gif)
+    <fmt> = [optional] output format, 'gif' or 'mp4' (requires ffmpeg) [default = 'gif']
+    <fast> = [optional] bool to write a bare grayscale gif straight from the pixel data, skipping matplotlib
+             (no wcs grid, titles or reticle, so gif only and not combined with tr or title) [default = False]
+    output = savefile (path of gif or mp4)
     """
+    if fast and fmt != 'gif':
+        raise ValueError("fast mode only writes gifs, not {}".format(fmt))
+    if fast and (tr or title):
+        raise ValueError("fast mode draws no reticle or title")
     if sort is True:
         fits_files = np.sort(frames)
     else:
         fits_files = frames
-    path = os.path.dirname(frames[0]).lstrip(' ')
+    path = os.path.dirname(frames[0].strip())
 
+    # hold the first few frames for init_fr rather than rendering duplicates
     start_frames = 5
-    copies = 1
+    durations = [fr] * len(fits_files)
     if init_fr and init_fr > fr and len(fits_files) > start_frames:
-        copies = init_fr // fr
-        i = 0
-        while i < start_frames * copies:
-            c = 1
-            while c < copies:
-                fits_files = np.insert(fits_files, i, fits_files[i])
-                i += 1
-                c += 1
-            i += 1
+        durations[:start_frames] = [init_fr] * start_frames
+
+    cube, headers = load_frames(fits_files, max_size=1024, center=center)
 
     # pull header information from first fits file
-    with fits.open(fits_files[0], ignore_missing_end=True) as hdul:
-        try:
-            header = hdul['SCI'].header
-        except KeyError:
-            try:
-                header = hdul['COMPRESSED_IMAGE'].header
-            except KeyError:
-                header = hdul[0].header
-        # create title
-        obj = header['OBJECT']
-        try:
-            rn = header['REQNUM'].lstrip('0')
-        except KeyError:
-            rn = 'UNKNOWN'
-        try:
-            site = header['SITEID'].upper()
-        except KeyError:
-            site = ' '
-        try:
-            inst = header['INSTRUME'].upper()
-        except KeyError:
-            inst = ' '
+    header = headers[0]
+    # create title
+    obj = header['OBJECT']
+    try:
+        rn = header['REQNUM'].lstrip('0')
+    except KeyError:
+        rn = 'UNKNOWN'
+    try:
+        site = header['SITEID'].upper()
+    except KeyError:
+        site = ' '
+    try:
+        inst = header['INSTRUME'].upper()
+    except KeyError:
+        inst = ' '
+
+    savefile = os.path.join(path, obj.translate(FILENAME_SAFE) + '_' + rn + '_guidemovie.' + fmt)
+
+    if fast:
+        write_fast_gif(cube, durations, savefile)
+        return savefile
 
     if title is None:
         # title = 'Request Number {} -- {} at {} ({})'.format(rn, obj, site, inst)
         title = 'LCOGT 1 meter Telescope at SAAO South Africa'
 
-    fig = plt.figure(figsize=(10, 10))
+    fig = plt.figure(figsize=(10, 10), dpi=90)
     if title:
         fig.suptitle(title, size='25', y=.93)
 
     time_in = datetime.now()
+    state = {}
+    zscale_every = 20
+    progress_every = max(1, len(fits_files) // 100)  # at most ~100 progress bar redraws
 
-    def update(n):
-        """ this method is required to build FuncAnimation
-        <file> = frame currently being iterated
-        output: return plot.
+    def build_axes(header_n):
+        """ create the axes once, projected onto the wcs of the first frame if possible
+        <header_n> = header of first frame
+        output: return axes.
         """
-
-        # get data/Header from Fits
-        with fits.open(fits_files[n], ignore_missing_end=True) as hdul:
-            try:
-                header_n = hdul['SCI'].header
-                data = hdul['SCI'].data
-            except KeyError:
-                try:
-                    header_n = hdul['COMPRESSED_IMAGE'].header
-                    data = hdul['COMPRESSED_IMAGE'].data
-                except KeyError:
-                    header_n = hdul[0].header
-                    data = hdul[0].data
-        if center:
-            shape = data.shape
-            x_frac = int(shape[0]/2.5)
-            y_frac = int(shape[1]/2.5)
-            data = data[x_frac:-x_frac, y_frac:-y_frac]
-            header_n['CRPIX1'] = header_n['CRPIX1'] - x_frac
-            header_n['CRPIX2'] = header_n['CRPIX2'] - y_frac
-
-        # dat_med = np.median(data)
-        # data -= dat_med
-        # pull Date from Header
-        try:
-            date_obs = header_n['DATE-OBS']
-        except KeyError:
-            date_obs = header_n['DATE_OBS']
-        try:
-            date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S.%f')
-        except ValueError:
-            date = datetime.strptime(date_obs, '%Y-%m-%dT%H:%M:%S')
-        # reset plot
-        ax = plt.gca()
-        ax.clear()
-        ax.axis('off')
-        z_interval = ZScaleInterval().get_limits(data)  # set z-scale
+        ax = None
         try:
             # set wcs grid/axes
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 wcs = WCS(header_n)  # get wcs transformation
-                ax = plt.gca(projection=wcs)
+                ax = fig.add_subplot(1, 1, 1, projection=wcs)
             dec = ax.coords['dec']
             dec.set_major_formatter('dd:mm')
             dec.set_ticks_position('br')
@@ -186,35 +315,116 @@ def make_gif(frames, title=None, sort=True, fr=100, init_fr=1000, tr=False, cent
             ra.set_ticklabel(fontsize=10, exclude_overlapping=True)
             ax.coords.grid(color='black', ls='solid', alpha=0.5)
         except (InvalidTransformError, AttributeError):
+            if ax is not None:
+                ax.remove()
+            ax = fig.add_subplot(1, 1, 1)
+            ax.axis('off')
+        return ax
+
+    def update_pointing(ax, header_n):
+        """ shift the existing wcs of ax to the pointing in header_n rather than rebuilding it """
+        wcs = getattr(ax, 'wcs', None)
+        if wcs is None:
+            return
+        try:
+            wcs.wcs.crpix = [header_n['CRPIX1'], header_n['CRPIX2']]
+            wcs.wcs.crval = [header_n['CRVAL1'], header_n['CRVAL2']]
+        except KeyError:
             pass
+
+    def update(n):
+        """ draws frame <n> onto fig
+        <n> = index of frame currently being iterated
+        output: return plot.
+        """
+
+        # get data/Header from preloaded frames
+        header_n = headers[n]
+        data = cube[n]
+
+        # apply_scale(data, np.median(data), 1)
+        # pull Date from Header
+        try:
+            date_obs = header_n['DATE-OBS']
+        except KeyError:
+            date_obs = header_n['DATE_OBS']
+        try:
+            date = datetime.fromisoformat(date_obs)
+        except ValueError:
+            # before python 3.11 fromisoformat only accepts 3 or 6 digit fractional seconds
+            date = datetime.strptime(date_obs, DATE_FORMAT_US if '.' in date_obs else DATE_FORMAT)
+        # axes are built on the first frame and reused afterwards
+        if 'ax' not in state:
+            state['ax'] = build_axes(header_n)
+        else:
+            update_pointing(state['ax'], header_n)
+        ax = state['ax']
+        # frames in a block share nearly identical sky levels, so only refresh the z-scale periodically
+        refresh_zscale = n % zscale_every == 0
+        if refresh_zscale:
+            state['zlim'] = zscale_limits(data)  # set z-scale
+        z_interval = state['zlim']
         # finish up plot
-        current_count = len(np.unique(fits_files[:n+1]))
-        ax.set_title('UT Date: {} ({} of {})'.format(date.strftime('%x %X'), current_count, int(len(fits_files)-(copies-1)*start_frames)), pad=10, size='25')
+        current_count = n + 1
+        frame_title = 'UT Date: {} ({} of {})'.format(date.strftime('%x %X'), current_count, len(fits_files))
+        if 'title' not in state:
+            state['title'] = ax.set_title(frame_title, pad=10, size='25')
+        else:
+            state['title'].set_text(frame_title)
 
         # norm = colors.SymLogNorm(linthresh=np.std(data), linscale=.1, vmin=z_interval[0], vmax=z_interval[1])
         # norm = colors.SymLogNorm(linthresh=np.std(data), linscale=.5, vmin=-50, vmax=70)
-        norm = colors.PowerNorm(gamma=1, vmin=z_interval[0], vmax=z_interval[1])
-        plt.imshow(data, cmap='gray', norm=norm)
+        if 'im' not in state:
+            norm = colors.PowerNorm(gamma=1, vmin=z_interval[0], vmax=z_interval[1])
+            state['im'] = ax.imshow(data, cmap='gray', norm=norm)
+        else:
+            state['im'].set_data(data)
+            if refresh_zscale:
+                state['im'].set_clim(z_interval[0], z_interval[1])
 
-        # If first few frames, add 5" and 15" reticle
-        if (current_count < 6 and fr != init_fr) and tr:
-            circle_5arcsec = plt.Circle((header_n['CRPIX1'], header_n['CRPIX2']), 5/header_n['PIXSCALE'], fill=False, color='limegreen', linewidth=1.5)
-            circle_15arcsec = plt.Circle((header_n['CRPIX1'], header_n['CRPIX2']), 15/header_n['PIXSCALE'], fill=False, color='lime', linewidth=1.5)
-            ax.add_artist(circle_5arcsec)
-            ax.add_artist(circle_15arcsec)
+        # If first few frames, show 5" and 15" reticle
+        if tr:
+            crpix = (header_n['CRPIX1'], header_n['CRPIX2'])
+            if 'reticle' not in state:
+                circle_5arcsec = plt.Circle(crpix, 5/header_n['PIXSCALE'], fill=False, color='limegreen', linewidth=1.5)
+                circle_15arcsec = plt.Circle(crpix, 15/header_n['PIXSCALE'], fill=False, color='lime', linewidth=1.5)
+                ax.add_artist(circle_5arcsec)
+                ax.add_artist(circle_15arcsec)
+                state['reticle'] = (circle_5arcsec, circle_15arcsec)
+            show_reticle = current_count < 6 and fr != init_fr
+            for circle in state['reticle']:
+                circle.set_center(crpix)
+                circle.set_visible(show_reticle)
 
-        if progress:
+        if progress and (n % progress_every == 0 or current_count == len(fits_files)):
             print_progress_bar(n+1, len(fits_files), prefix='Creating Gif: Frame {}'.format(current_count), time_in=time_in)
         return ax
 
-    ax1 = update(0)
-    plt.tight_layout(pad=4)
+    def grab_frame():
+        """ render current state of fig into a paletted Pillow image """
+        fig.canvas.draw()
+        rgb = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert('RGB')
+        return rgb.quantize(method=Image.MEDIANCUT)
 
-    # takes in fig, update function, and frame rate set to fr
-    anim = FuncAnimation(fig, update, frames=len(fits_files), blit=False, interval=fr)
+    update(0)
+    fig.tight_layout(pad=4)
 
-    savefile = os.path.join(path, obj.replace(' ', '_').replace('/', '_') + '_' + rn + '_guidemovie.gif')
-    anim.save(savefile, dpi=90, writer='imagemagick')
+    if fmt == 'mp4':
+        # stream raw frames straight to ffmpeg; a constant frame rate means the intro is held by repeating frames
+        writer = FFMpegWriter(fps=1000/fr, codec='libx264', extra_args=['-pix_fmt', 'yuv420p', '-preset', 'veryfast'])
+        with writer.saving(fig, savefile, dpi=90):
+            for n in range(len(fits_files)):
+                if n:
+                    update(n)
+                for _ in range(max(1, int(durations[n] // fr))):
+                    writer.grab_frame()
+    else:
+        gif_frames = [grab_frame()]
+        for n in range(1, len(fits_files)):
+            update(n)
+            gif_frames.append(grab_frame())
+        # Pillow accepts a per-frame duration list, so the slow intro needs no duplicate frames
+        gif_frames[0].save(savefile, save_all=True, append_images=gif_frames[1:], duration=durations, loop=0, disposal=2, optimize=True)
 
     return savefile
 
@@ -226,21 +436,39 @@ if __name__ == '__main__':
     parser.add_argument("--ir", help="Frame rate in ms/frame for first 5 frames (Defaults to 1000 ms/frame or 1 frames/second", default=1000, type=float)
     parser.add_argument("--tr", help="Add target circle at crpix values?", default=False, action="store_true")
     parser.add_argument("--C", help="Only include Center Snapshot", default=False, action="store_true")
+    parser.add_argument("--fast", help="Quick preview gif with no axes, titles or reticle", default=False, action="store_true")
+    parser.add_argument("--fmt", help="Output format (Defaults to gif; mp4 requires ffmpeg)", default='gif', choices=['gif', 'mp4'])
     args = parser.parse_args()
+    if args.fast and args.fmt != 'gif':
+        parser.error("--fast only supports --fmt gif")
+    if args.fast and args.tr:
+        parser.error("--fast cannot draw the --tr reticle")
     path = args.path
     fr = args.fr
     ir = args.ir
     tr = args.tr
     center = args.C
+    fmt = args.fmt
+    fast = args.fast
     print("Base Framerate: {}".format(fr))
     if path[-1] != '/':
         path += '/'
-    files = np.sort(glob(path+'*.fits.fz'))
-    if len(files) < 1:
-        files = np.sort(glob(path+'*.fits'))
+    # one pass over the directory, preferring compressed frames when present
+    fz_files = []
+    fits_files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # like glob, skip hidden files (e.g. macOS ._ AppleDouble files) and anything that is not a file
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            if entry.name.endswith('.fits.fz'):
+                fz_files.append(entry.path)
+            elif entry.name.endswith('.fits'):
+                fits_files.append(entry.path)
+    files = sorted(fz_files) or sorted(fits_files)
     if len(files) >= 1:
-        gif_file = make_gif(files, fr=fr, init_fr=ir, tr=tr, center=center, progress=True)
-        print("New gif created: {}".format(gif_file))
+        gif_file = make_gif(files, fr=fr, init_fr=ir, tr=tr, center=center, progress=True, fmt=fmt, fast=fast)
+        print("New {} created: {}".format(fmt, gif_file))
     else:
         print("No files found.")
 